@@ -1,13 +1,20 @@
 # config.py
 #source .venv/bin/activate
 #/usr/local/bin/cloudflared tunnel --url http://localhost:5000
+# Gateway log level ("DEBUG" shows every received/published message)
+LOG_LEVEL = "INFO"
+
 # MQTT Settings
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
+# Fixed client id so the broker keeps a persistent session (empty = random id, clean session)
+MQTT_CLIENT_ID = "eldersafe-gateway"
 TOPIC_MOTION = "elder/sensor/motion"
 TOPIC_CAM = "elder/gateway/cam"
 TOPIC_ENV = "elder/gateway/env"
 TOPIC_CLOUD_MOTION = "elder/cloud/motion"
+# Messages buffered for the MQTT publisher thread before new ones are dropped
+MQTT_PUBLISH_QUEUE_MAX = 1000
 
 # GPIO Pins (BCM)
 PIN_BUZZER = 21
@@ -23,16 +30,64 @@ SMOKE_ADC_CHANNEL = 0  # ADS1115 channel for smoke sensor (AO pin)
 G_FORCE_LIMIT = 1.8
 MIC_THRESHOLD = 150
 
+# Seconds after an emergency is triggered during which further triggers
+# (e.g. a burst of high-g samples) are ignored
+EMERGENCY_COOLDOWN = 5
+
+# Motion samples closer than these deltas to the last stored sample are not
+# written to InfluxDB, except at least once every MOTION_WRITE_HEARTBEAT s
+MOTION_G_EPSILON = 0.02
+MOTION_MIC_EPSILON = 2
+MOTION_WRITE_HEARTBEAT = 1.0  # seconds
+
 # Camera fall detection confidence threshold (0.0 - 1.0)
 # Vision must return a confidence score in this range. Camera-triggered
 # emergencies will only fire when the returned confidence >= this value.
 CAM_FALL_CONF_THRESHOLD = 0.6
 
+# Pi Camera buffers; the MJPEG encoder holds frames while FaceMesh reads the
+# lores stream, so keep enough in flight to avoid dropped frames
+CAMERA_BUFFER_COUNT = 6
+
+# Minimum seconds between FaceMesh runs (~3 Hz); the video stream is not limited
+FACE_MESH_INTERVAL = 0.33
+# OpenCV/OpenMP worker threads (tuned for a 4-core Pi sharing cores with the
+# capture, FaceMesh, MQTT and web threads)
+CV_THREADS = 2
+
 # Environment publish interval (seconds)
 ENV_INTERVAL = 5
+# Background DHT sampling period (seconds; the DHT11 needs at least 2 s between reads)
+DHT_SAMPLE_INTERVAL = 2.5
+# A DHT reading older than this (seconds, a few sample intervals) is reported as "N/A"
+DHT_STALE_AFTER = 10.0
 
 # InfluxDB Settings
 INFLUXDB_URL = "http://localhost:8086"
 INFLUXDB_TOKEN = ""  # For InfluxDB 1.x, no token needed
 INFLUXDB_ORG = ""  # Not used in 1.x
 INFLUXDB_BUCKET = "eldersafe"  # Database name
+
+# Web server worker threads (each open /video_feed stream holds one)
+WEB_THREADS = 8
+# Per-client frame rate cap for /video_feed
+STREAM_MAX_FPS = 25
+# Hardware MJPEG quality preset for /video_feed: VERY_LOW, LOW, MEDIUM, HIGH, VERY_HIGH
+STREAM_QUALITY = "LOW"
+
+# Seconds the /dashboard and /dashboard_data query results are cached
+DASHBOARD_CACHE_TTL = 30
+# Time bucket the dashboard series are aggregated into by InfluxDB
+DASHBOARD_BUCKET = '1m'
+
+# InfluxDB batch writer: flush once INFLUX_FLUSH_POINTS are queued or every
+# INFLUX_FLUSH_INTERVAL seconds, whichever first; each HTTP write carries at
+# most INFLUX_BATCH_SIZE points
+INFLUX_FLUSH_POINTS = 100
+INFLUX_FLUSH_INTERVAL = 1.0  # seconds
+INFLUX_BATCH_SIZE = 1000
+INFLUX_QUEUE_MAX = 50000  # points kept in memory while InfluxDB is unreachable
+INFLUX_RETRY_MAX_BACKOFF = 30.0  # seconds; cap for the retry backoff while writes fail
+# Timestamp precision for writes ('s', 'ms', 'u', 'n'). Coarser compresses
+# better; 'ms' keeps several-Hz motion samples from sharing a timestamp.
+INFLUX_TIME_PRECISION = 'ms'
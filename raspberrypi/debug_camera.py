@@ -11,7 +11,7 @@ def test_camera():
     try:
         picam2.configure(
             picam2.create_preview_configuration(
-                main={"format": "XRGB8888", "size": (640, 480)}
+                main={"format": "YUV420", "size": (640, 480)}
             )
         )
         picam2.start()
@@ -33,10 +33,7 @@ def test_camera():
         start_time = time.time()
         while time.time() - start_time < 10:
             frame_raw = picam2.capture_array()
-            if frame_raw.shape[2] == 4:
-                frame = cv2.cvtColor(frame_raw, cv2.COLOR_BGRA2BGR)
-            else:
-                frame = frame_raw.copy()
+            frame = cv2.cvtColor(frame_raw, cv2.COLOR_YUV2BGR_I420)
             cv2.imshow('Pi Camera Debug', frame)
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
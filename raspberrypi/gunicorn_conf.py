@@ -0,0 +1,25 @@
+"""Gunicorn settings: `gunicorn -c gunicorn_conf.py main:app`.
+
+Picamera2 can only be opened by one process, so the gateway runs as a single
+worker; threads serve the long-lived /video_feed streams next to the API.
+"""
+import config
+
+bind = "0.0.0.0:5000"
+workers = 1
+worker_class = "gthread"
+threads = config.WEB_THREADS
+
+
+def post_worker_init(worker):
+    # `python main.py` starts these from __main__; under gunicorn the app
+    # module is imported instead, so start them once the worker is up
+    import main
+    main.start_services()
+
+
+def worker_exit(server, worker):
+    # counterpart of post_worker_init: flush queued InfluxDB points and
+    # stop recording when gunicorn shuts the worker down
+    import main
+    main.stop_services()
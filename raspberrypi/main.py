@@ -1,31 +1,53 @@
 """Main gateway runner for ElderSafe Gateway.
 
-Usage: `python main.py`
+Usage: `python main.py` (waitress), or
+`gunicorn -c gunicorn_conf.py main:app` (single gthread worker)
 
 This script subscribes to `elder/sensor/motion` and acts on camera verification
 and publishes environment data periodically to `elder/sensor/env`.
 Also runs web stream at http://<pi-ip>:5000
 """
 import time
-import json
+import math
+import logging
+import operator
 import threading
+from concurrent.futures import ThreadPoolExecutor
+import os
 import config
+# Cap OpenMP/OpenCV worker threads (config.CV_THREADS) so FaceMesh, the vision
+# check and the web/MQTT threads don't oversubscribe the Pi's 4 cores; must
+# be set before the modules below import OpenCV/MediaPipe
+os.environ.setdefault("OMP_NUM_THREADS", str(config.CV_THREADS))
+os.environ.setdefault("MEDIAPIPE_DISABLE_GPU", "1")
 from modules.hardware_ctrl import HardwareManager
 from modules.vision_ai import VisionSystem
 from modules.mqtt_handler import MQTTHandler
+from modules.influx_writer import InfluxWriter, line_protocol
+from modules.frame_slot import FrameSlot, SlotWriter
 
 # Flask imports
 from flask import Flask, Response, render_template, jsonify
 from flask_cors import CORS
+from waitress import serve
 import cv2
-from picamera2 import Picamera2
+from picamera2 import Picamera2, MappedArray
+from picamera2.encoders import MJPEGEncoder, Quality
+from picamera2.outputs import FileOutput
+from libcamera import Transform
 import mediapipe as mp
 import numpy as np
+import orjson
 import time
 
 # InfluxDB imports
 from influxdb import InfluxDBClient
 
+# Per-message/per-tick chatter is DEBUG; events and errors are INFO/WARNING
+log = logging.getLogger("eldersafe")
+
+cv2.setNumThreads(config.CV_THREADS)
+
 # Flask app
 app = Flask(__name__, template_folder='../frontend')
 CORS(app, origins=["https://iot-final-project-wine.vercel.app", "http://localhost:5000"])
@@ -33,17 +55,28 @@ CORS(app, origins=["https://iot-final-project-wine.vercel.app", "http://localhos
 # MediaPipe
 mp_face_mesh = mp.solutions.face_mesh
 
-# Global states for web
-fall_status = "Status: OK"
-global_expression = "Neutral"
-global_temperature = "N/A"
-global_humidity = "N/A"
-global_smoke_status = "SMOKE_OK"
-global_critical_alert = "ALERT_OK"
-global_latest_g_force = 0.0
-global_latest_mic = 0.0
-global_camera_fall_detected = False
-global_camera_confidence = 0.0
+# Live state for the web UI and overlay. Writers publish a new dict through
+# update_state(); readers take `s = STATE` once and get a consistent snapshot
+# without locking (rebinding a module global is atomic).
+STATE = {
+    "expression": "Neutral",
+    "temperature": "N/A",
+    "humidity": "N/A",
+    "smoke_status": "SMOKE_OK",
+    "critical_alert": "ALERT_OK",
+    "g_force": 0.0,
+    "mic": 0.0,
+    "camera_fall_detected": False,
+    "camera_confidence": 0.0,
+}
+_state_lock = threading.Lock()
+
+
+def update_state(**changes):
+    global STATE
+    # the lock only serializes writers so concurrent updates aren't lost
+    with _state_lock:
+        STATE = {**STATE, **changes}
 
 # Emotion mapping (string -> numeric code)
 EMOTION_MAP = {
@@ -55,37 +88,48 @@ EMOTION_MAP = {
 }
 
 # Camera for web stream (Pi Camera)
+# "main" feeds the hardware MJPEG encoder (overlay drawn in place); RGB888 is
+# 3 bytes/px with BGR memory order, so OpenCV draws on it without conversion.
+# "lores" is the YUV420 stream read by FaceMesh and the vision heuristics
+# (the Pi 4 ISP only produces YUV on lores). The mirror is done by the ISP
+# (hflip) instead of a per-frame cv2.flip.
+FRAME_W, FRAME_H = 640, 480
 picam2 = Picamera2()
 picam2.configure(
-    picam2.create_preview_configuration(
-        main={"format": "XRGB8888", "size": (640, 480)}
+    picam2.create_video_configuration(
+        main={"format": "RGB888", "size": (FRAME_W, FRAME_H)},
+        lores={"format": "YUV420", "size": (FRAME_W, FRAME_H)},
+        transform=Transform(hflip=1),
+        buffer_count=config.CAMERA_BUFFER_COUNT
     )
 )
-picam2.start()
-time.sleep(0.5)  # Warm-up time
 
 # Initialize hardware and vision early
 hw = HardwareManager(config)
-vision = VisionSystem(picam2=picam2)
+vision = VisionSystem(picam2=picam2, stream="lores")
 
-# Initialize InfluxDB client
-influx_client = InfluxDBClient(host='localhost', port=8086, database=config.INFLUXDB_BUCKET)
+# Initialize InfluxDB client; it already keeps one keep-alive requests
+# session, so only the pool is sized for our few callers (the batch writer
+# and dashboard queries). Retries stay with the client's own `retries` loop.
+influx_client = InfluxDBClient(host='localhost', port=8086, database=config.INFLUXDB_BUCKET,
+                               pool_size=4)
+# Points are queued and flushed in batches by a background thread
+influx_writer = InfluxWriter(config, influx_client)
 
 # --------------------------------------------------
 # FACIAL EXPRESSION DETECTION
 # --------------------------------------------------
-def euclidean(p1, p2):
-    return np.linalg.norm(np.array([p1.x, p1.y]) - np.array([p2.x, p2.y]))
+# Eye corners (33, 263), mouth corners (61, 291), inner lips (13, 14);
+# fetched from the landmark list in a single C-level call per frame
+_emotion_landmarks = operator.itemgetter(33, 263, 61, 291, 13, 14)
 
 def classify_emotion(lm):
-    LEC, REC = 33, 263
-    ML, MR = 61, 291
-    LU, LD = 13, 14
-    io = euclidean(lm[LEC], lm[REC])
+    lec, rec, ml, mr, lu, ld = _emotion_landmarks(lm)
+    io = math.hypot(lec.x - rec.x, lec.y - rec.y)
     if io < 1e-6: return "Neutral"
 
-    mw = euclidean(lm[ML], lm[MR]) / io
-    mo = euclidean(lm[LU], lm[LD]) / io
+    mw = math.hypot(ml.x - mr.x, ml.y - mr.y) / io
+    mo = math.hypot(lu.x - ld.x, lu.y - ld.y) / io
 
     if mo > 0.08: return "Surprised"
     if mw > 0.48: return "Happy"
@@ -93,93 +137,80 @@ def classify_emotion(lm):
     return "Neutral"
 
 
-def on_mqtt_message(client, userdata, msg):
-    global global_temperature, global_humidity, global_smoke_status
-    global global_critical_alert, global_latest_g_force, global_expression
+# Last motion sample written to InfluxDB, used to coalesce near-duplicates
+_last_motion_write = {"g_force": None, "mic": None, "ts": 0.0}
 
+
+def should_write_motion(g_val, mic_val):
+    """Skip samples that barely differ from the last written one.
+
+    Impacts above G_FORCE_LIMIT are always written, and an unchanged value is
+    still written once every MOTION_WRITE_HEARTBEAT seconds.
+    """
+    last = _last_motion_write
+    now = time.monotonic()
+    if (g_val <= config.G_FORCE_LIMIT
+            and last["g_force"] is not None
+            and abs(g_val - last["g_force"]) < config.MOTION_G_EPSILON
+            and abs(mic_val - last["mic"]) < config.MOTION_MIC_EPSILON
+            and now - last["ts"] < config.MOTION_WRITE_HEARTBEAT):
+        return False
+    last["g_force"], last["mic"], last["ts"] = g_val, mic_val, now
+    return True
+
+
+def on_mqtt_message(client, userdata, msg):
     topic = msg.topic
+    # one timestamp for every point produced by this message
+    ts = influx_writer.timestamp()
     try:
-        payload = json.loads(msg.payload.decode())
-    except Exception:
+        # orjson parses the raw bytes directly, no intermediate str
+        payload = orjson.loads(msg.payload)
+    except orjson.JSONDecodeError:
         payload = None
 
-    print(f"[MQTT] Received on {topic}: {payload}")
+    log.debug("[MQTT] Received on %s: %s", topic, payload)
 
     if topic == config.TOPIC_MOTION and payload:
         try:
             g_val = float(payload.get('g_force', 0))
             mic_val = float(payload.get('mic', 0))
         except Exception:
-            g_val = 0
-            mic_val = 0
-
-        # Forward raw motion data to cloud
-        mqtt.publish(config.TOPIC_CLOUD_MOTION, payload)
-        print(f"[CLOUD] Forwarded motion: {payload}")
-
-        # Write cloud motion to InfluxDB
-        json_body = [
-            {
-                "measurement": "cloud_motion",
-                "tags": {
-                    "sensor": "esp32"
-                },
-                "fields": {
-                    "g_force": g_val,
-                    "mic": mic_val
-                },
-                "time": int(time.time() * 1e9)
-            }
-        ]
-        influx_client.write_points(json_body)
-
-        global_latest_g_force = g_val
-        global global_latest_mic
-        global_latest_mic = mic_val
-
-        # Write motion to InfluxDB
-        json_body = [
-            {
-                "measurement": "motion",
-                "tags": {
-                    "sensor": "esp32"
-                },
-                "fields": {
-                    "g_force": g_val,
-                    "mic": mic_val
-                },
-                "time": int(time.time() * 1e9)
-            }
-        ]
-        influx_client.write_points(json_body)
+            # floats, so the Influx field type matches real samples
+            g_val = 0.0
+            mic_val = 0.0
+
+        # Forward raw motion data to cloud; the received bytes are already
+        # JSON, so they go out as-is instead of being re-serialized
+        mqtt.publish(config.TOPIC_CLOUD_MOTION, msg.payload)
+        log.debug("[CLOUD] Forwarded motion: %s", payload)
+
+        update_state(g_force=g_val, mic=mic_val)
+
+        # Write motion to InfluxDB (cloud forwarding is MQTT-only; the old
+        # identical cloud_motion point is no longer stored)
+        if should_write_motion(g_val, mic_val):
+            influx_writer.write(line_protocol("motion", {"sensor": "esp32"},
+                                              {"g_force": g_val, "mic": mic_val},
+                                              ts))
 
         if g_val > config.G_FORCE_LIMIT:
-            print('[LOGIC] High impact -> triggering emergency protocol')
-            # run emergency in separate thread so env loop continues
-            threading.Thread(target=handle_emergency, args=(mqtt,)).start()
-            global_critical_alert = "FALL DETECTED"
+            log.info('[LOGIC] High impact -> triggering emergency protocol')
+            trigger_emergency(mqtt)
+            update_state(critical_alert="FALL DETECTED")
 
             # Write fall to InfluxDB
-            json_body = [
-                {
-                    "measurement": "camera",
-                    "tags": {
-                        "sensor": "picam"
-                    },
-                    "fields": {
-                        "fall_detected": 1,
-                        "emotion": global_expression
-                    },
-                    "time": int(time.time() * 1e9)
-                }
-            ]
-            influx_client.write_points(json_body)
+            influx_writer.write(line_protocol("camera", {"sensor": "picam"},
+                                              {"fall_detected": 1, "emotion": STATE["expression"]},
+                                              ts))
         else:
-            global_critical_alert = "ALERT_OK"
+            update_state(critical_alert="ALERT_OK")
 
     elif topic == config.TOPIC_CAM and payload:
         # If publisher included a confidence score, require it to exceed threshold
-        fall_val = int(payload.get('fall_detected', 0))
+        # normalized once here: other publishers on the broker may send "1",
+        # true or 1.0, and the Influx field must stay an int
+        fall_val = 1 if payload.get('fall_detected') in (1, True, '1') else 0
         conf_raw = payload.get('confidence', payload.get('camera_confidence', payload.get('cam_confidence', None)))
         conf = None
         try:
@@ -197,33 +228,42 @@ def on_mqtt_message(client, userdata, msg):
                 trigger = (conf >= config.CAM_FALL_CONF_THRESHOLD)
 
         if trigger:
-            print('[LOGIC] Confirmed fall -> triggering emergency protocol')
-            # run emergency in separate thread so env loop continues
-            threading.Thread(target=handle_emergency, args=(mqtt,)).start()
+            log.info('[LOGIC] Confirmed fall -> triggering emergency protocol')
+            trigger_emergency(mqtt)
         # log camera confidence when present for realtime debugging
         if conf is not None:
-            print(f"[VISION_CONF][MQTT] Received camera confidence: {conf}")
+            log.debug("[VISION_CONF][MQTT] Received camera confidence: %s", conf)
 
         # Write received cam data to InfluxDB (store camera confidence when provided)
         json_fields = {
             "fall_detected": fall_val,
             "emotion": payload.get('emotions', 'Unknown'),
-            "emotion_code": EMOTION_MAP.get(str(payload.get('emotions', 'Unknown')), -1)
+            "emotion_code": EMOTION_MAP.get(payload.get('emotions'), -1)
         }
         if conf is not None:
             json_fields["camera_confidence"] = conf
 
-        json_body = [
-            {
-                "measurement": "camera",
-                "tags": {
-                    "sensor": "picam"
-                },
-                "fields": json_fields,
-                "time": int(time.time() * 1e9)
-            }
-        ]
-        influx_client.write_points(json_body)
+        influx_writer.write(line_protocol("camera", {"sensor": "picam"}, json_fields,
+                                          ts))
+
+
+# Emergencies run one at a time on a single worker so the actuators never get
+# overlapping commands; re-triggers within EMERGENCY_COOLDOWN are dropped
+_emergency_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="emergency")
+_emergency_lock = threading.Lock()
+_last_emergency = None
+
+
+def trigger_emergency(mqtt_client):
+    """Queue handle_emergency unless one was triggered within the cooldown."""
+    global _last_emergency
+    now = time.monotonic()
+    with _emergency_lock:
+        if _last_emergency is not None and now - _last_emergency < config.EMERGENCY_COOLDOWN:
+            return
+        _last_emergency = now
+    # runs off the caller's thread so the MQTT callback and env loop continue
+    _emergency_pool.submit(handle_emergency, mqtt_client)
 
 
 def handle_emergency(mqtt_client):
@@ -235,12 +275,9 @@ def handle_emergency(mqtt_client):
 
 
 def emotion_publish_loop(mqtt_client):
-    global global_expression
-    global global_camera_fall_detected
-    global global_camera_confidence
     while True:
         # Use vision system to analyze scene (may return None on error)
-        fall_flag = '0'
+        fall_flag = 0
         camera_conf = 0.0
         try:
             vres = vision.analyze_scene()
@@ -251,68 +288,47 @@ def emotion_publish_loop(mqtt_client):
                 except Exception:
                     camera_conf = 0.0
                 # Only treat as fall if confidence meets threshold
-                if str(vres.get('fall_detected')) == '1' and camera_conf >= config.CAM_FALL_CONF_THRESHOLD:
-                    fall_flag = '1'
+                if vres.get('fall_detected') == 1 and camera_conf >= config.CAM_FALL_CONF_THRESHOLD:
+                    fall_flag = 1
         except Exception as e:
-            print(f"[VISION] analyze_scene error: {e}")
+            log.warning("[VISION] analyze_scene error: %s", e)
 
         # If vision detects a fall (with sufficient confidence), trigger emergency
-        if fall_flag == '1':
-            print('[VISION] Fall detected by camera (conf={}) -> triggering emergency protocol'.format(camera_conf))
-            # update global for overlay
-            global_camera_fall_detected = True
-            threading.Thread(target=handle_emergency, args=(mqtt_client,)).start()
-        else:
-            global_camera_fall_detected = False
+        if fall_flag:
+            log.info('[VISION] Fall detected by camera (conf=%s) -> triggering emergency protocol', camera_conf)
+            trigger_emergency(mqtt_client)
 
-        # update global confidence for overlay/API and log it
-        global_camera_confidence = float(round(camera_conf, 2))
-        print(f"[VISION_CONF] camera_confidence={global_camera_confidence}")
+        # update fall flag and confidence for overlay/API and log it
+        camera_confidence = float(round(camera_conf, 2))
+        update_state(camera_fall_detected=bool(fall_flag), camera_confidence=camera_confidence)
+        log.debug("[VISION_CONF] camera_confidence=%s", camera_confidence)
+        expression = STATE["expression"]
 
         # Publish current emotion and fall flag (include confidence)
-        payload = {"fall_detected": fall_flag, "emotions": global_expression, "confidence": global_camera_confidence}
+        payload = {"fall_detected": fall_flag, "emotions": expression, "confidence": camera_confidence}
+        # The gateway is subscribed to TOPIC_CAM, so on_mqtt_message stores
+        # this payload as the camera point; writing it here too doubled it
         mqtt_client.publish(config.TOPIC_CAM, payload)
-        print(f"[EMOTION] Published: {payload}")
-
-        # Write to InfluxDB (store emotion, fall flag and camera confidence)
-        json_body = [
-            {
-                "measurement": "camera",
-                "tags": {
-                    "sensor": "picam"
-                },
-                "fields": {
-                    "fall_detected": 1 if fall_flag == '1' else 0,
-                    "emotion": global_expression,
-                    "emotion_code": EMOTION_MAP.get(global_expression, -1),
-                    "camera_confidence": float(round(camera_conf, 2))
-                },
-                "time": int(time.time() * 1e9)
-            }
-        ]
-        try:
-            influx_client.write_points(json_body)
-        except Exception as e:
-            print(f"[INFLUX] write error (camera): {e}")
+        log.debug("[EMOTION] Published: %s", payload)
 
         time.sleep(10)  # Publish every 10 seconds
 
 
 def env_loop(mqtt_client):
-    global global_temperature, global_humidity, global_smoke_status
-
+    # Readings run on a fixed ENV_INTERVAL grid anchored to the monotonic
+    # clock, so the time spent reading/publishing doesn't accumulate as drift
+    next_t = time.monotonic()
     while True:
         env = hw.read_env()
         env['timestamp'] = time.time()
-        mqtt_client.publish(config.TOPIC_ENV, env)
-        print(f"[ENV] Published: {env}")
-        time.sleep(config.ENV_INTERVAL)
+        mqtt_client.publish_env(env['temp'], env['humidity'], env['smoke'], env['timestamp'])
+        log.debug("[ENV] Published: %s", env)
 
-        # Update globals for web
-        global_temperature = str(env.get('temp', 'N/A'))
-        global_humidity = str(env.get('humidity', 'N/A'))
+        # Update state for web
         smoke = env.get('smoke', 0)
-        global_smoke_status = "SMOKE_DETECTED" if smoke == 1 else "SMOKE_OK"
+        update_state(temperature=str(env.get('temp', 'N/A')),
+                     humidity=str(env.get('humidity', 'N/A')),
+                     smoke_status="SMOKE_DETECTED" if smoke == 1 else "SMOKE_OK")
 
         # Write to InfluxDB
         fields = {"smoke": smoke}
@@ -321,77 +337,121 @@ def env_loop(mqtt_client):
         if env.get('humidity') != "N/A":
             fields["humidity"] = env.get('humidity')
 
-        json_body = [
-            {
-                "measurement": "environment",
-                "tags": {
-                    "sensor": "dht"
-                },
-                "fields": fields,
-                "time": int(env['timestamp'] * 1e9)
-            }
-        ]
-        influx_client.write_points(json_body)
+        influx_writer.write(line_protocol("environment", {"sensor": "dht"}, fields,
+                                          influx_writer.timestamp(env['timestamp'])))
+
+        next_t += config.ENV_INTERVAL
+        now = time.monotonic()
+        if next_t < now:
+            # a slow read (e.g. DHT retries) overran the slot; re-anchor
+            # instead of firing a burst of catch-up reads
+            next_t = now
+        time.sleep(next_t - now)
 
 
 # --------------------------------------------------
 # MAIN VIDEO STREAM LOOP
 # --------------------------------------------------
-def generate_frames():
-    global global_expression
-    global global_camera_fall_detected, global_critical_alert
+# face_loop grabs a "lores" frame only when FaceMesh is due (expression only).
+# draw_overlay runs on every "main" frame before the hardware MJPEG encoder,
+# which writes finished JPEGs to jpeg_frames for the /video_feed clients.
+# The slot keeps only the latest JPEG, so a slow client never stalls the rest.
+jpeg_frames = FrameSlot()
+
 
+def face_loop():
+    # classify_emotion only reads base-mesh landmarks, so the extra
+    # iris/lips refinement model is skipped
     with mp_face_mesh.FaceMesh(max_num_faces=1,
-                               refine_landmarks=True,
+                               refine_landmarks=False,
                                min_detection_confidence=0.5,
                                min_tracking_confidence=0.5) as face:
 
-        while True:
-            frame_raw = picam2.capture_array()
+        # Working buffer, reused every iteration (no per-frame malloc)
+        rgb = np.empty((FRAME_H, FRAME_W, 3), np.uint8)
 
-            # Convert BGRA → BGR
-            if frame_raw.shape[2] == 4:
-                frame = cv2.cvtColor(frame_raw, cv2.COLOR_BGRA2BGR)
-            else:
-                frame = frame_raw.copy()
-
-            frame = cv2.flip(frame, 1)
-            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # FaceMesh → Expression
-            face_result = face.process(rgb)
-            expression = "No Face"
-            if face_result.multi_face_landmarks:
-                lm = face_result.multi_face_landmarks[0].landmark
-                expression = classify_emotion(lm)
-            global_expression = expression
-            # overlay emotion and standing/fall status
-            expr_code = EMOTION_MAP.get(global_expression, -1)
-            fall_state = "FALL" if (global_camera_fall_detected or global_critical_alert == "FALL DETECTED") else "Standing"
-            cv2.putText(frame, f"Expr: {expression} ({expr_code})", (10, 30),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 2)
-            cv2.putText(frame, f"Status: {fall_state}", (10, 60),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255) if fall_state=="FALL" else (0,255,0), 2)
-            # overlay realtime camera confidence (percentage)
+        # Expression is only published every 10 s and changes slowly, so
+        # FaceMesh runs at most every FACE_MESH_INTERVAL seconds on the
+        # newest frame; the stream itself keeps the full camera rate
+        next_t = time.monotonic()
+        while True:
+            delay = next_t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_t = time.monotonic() + config.FACE_MESH_INTERVAL
             try:
-                conf_pct = int(global_camera_confidence * 100)
-            except Exception:
-                conf_pct = 0
-            cv2.putText(frame, f"Conf: {conf_pct}%", (10, 90),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (200, 200, 200), 2)
+                # Captured on demand: copying every lores frame at camera
+                # rate would throw most of them away
+                frame_raw = picam2.capture_array("lores")
+
+                # Convert planar YUV420 (1.5 bytes/px) → RGB for MediaPipe
+                cv2.cvtColor(frame_raw, cv2.COLOR_YUV2RGB_I420, dst=rgb)
+
+                # FaceMesh → Expression
+                face_result = face.process(rgb)
+                expression = "No Face"
+                if face_result.multi_face_landmarks:
+                    lm = face_result.multi_face_landmarks[0].landmark
+                    expression = classify_emotion(lm)
+                if expression != STATE["expression"]:
+                    update_state(expression=expression)
+            except Exception as e:
+                log.warning("[FACE] capture/FaceMesh error: %s", e)
+
+
+def draw_overlay(request):
+    """Picamera2 pre_callback: draw status text on the frame before encoding."""
+    s = STATE
+    # overlay emotion and standing/fall status
+    expr_code = EMOTION_MAP.get(s["expression"], -1)
+    fall_state = "FALL" if (s["camera_fall_detected"] or s["critical_alert"] == "FALL DETECTED") else "Standing"
+    # overlay realtime camera confidence (percentage)
+    try:
+        conf_pct = int(s["camera_confidence"] * 100)
+    except Exception:
+        conf_pct = 0
+    with MappedArray(request, "main") as m:
+        cv2.putText(m.array, f"Expr: {s['expression']} ({expr_code})", (10, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 2)
+        cv2.putText(m.array, f"Status: {fall_state}", (10, 60),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255) if fall_state=="FALL" else (0,255,0), 2)
+        cv2.putText(m.array, f"Conf: {conf_pct}%", (10, 90),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (200, 200, 200), 2)
+
 
-            ret, buf = cv2.imencode(".jpg", frame)
-            if not ret: continue
-            yield(b"--frame\r\nContent-Type:image/jpeg\r\n\r\n"+buf.tobytes()+b"\r\n")
+def generate_frames():
+    # cap each client at STREAM_MAX_FPS; frames arriving in between are skipped
+    frame_period = 1.0 / config.STREAM_MAX_FPS
+    next_t = time.monotonic()
+    version = 0
+    while True:
+        delay = next_t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        new_version, jpeg = jpeg_frames.get(version, timeout=1.0)
+        if new_version == version:
+            continue
+        version = new_version
+        next_t = time.monotonic() + frame_period
+        yield(b"--frame\r\nContent-Type:image/jpeg\r\n\r\n"+jpeg+b"\r\n")
+
+
+picam2.pre_callback = draw_overlay
+# main has to stay at least as large as lores, so the stream size is bounded
+# through the encoder's quality preset rather than by downscaling
+picam2.start_recording(MJPEGEncoder(), FileOutput(SlotWriter(jpeg_frames)),
+                       quality=Quality[config.STREAM_QUALITY])
+time.sleep(0.5)  # Warm-up time
 
 # --------------------------------------------------
 # FLASK ROUTES
 # --------------------------------------------------
 @app.route("/")
 def index():
+    s = STATE
     return render_template("index.html",
-                           temp=global_temperature,
-                           hum=global_humidity)
+                           temp=s["temperature"],
+                           hum=s["humidity"])
 
 @app.route("/video_feed")
 def video_feed():
@@ -400,123 +460,107 @@ def video_feed():
 
 @app.route("/env_status_api")
 def env_status_api():
-    global global_temperature, global_humidity
-    global global_smoke_status, global_critical_alert
-    global global_latest_g_force, global_expression
-
-    global global_latest_mic
-    global global_camera_confidence
-
+    s = STATE
     return jsonify({
-        "temperature": global_temperature,
-        "humidity": global_humidity,
-        # "fall_status": "Status: OK",  # Placeholder, updated from vision
-        "smoke_status": global_smoke_status,
-        "critical_alert": global_critical_alert,
-        "g_force_latest": global_latest_g_force,
-        "mic_latest": global_latest_mic,
-        "camera_confidence": global_camera_confidence,
-        "expression": global_expression,
-        "expression_code": EMOTION_MAP.get(global_expression, -1)
+        "temperature": s["temperature"],
+        "humidity": s["humidity"],
+        "smoke_status": s["smoke_status"],
+        "critical_alert": s["critical_alert"],
+        "g_force_latest": s["g_force"],
+        "mic_latest": s["mic"],
+        "camera_confidence": s["camera_confidence"],
+        "expression": s["expression"],
+        "expression_code": EMOTION_MAP.get(s["expression"], -1)
     })
 
+# One multi-statement query (one HTTP round-trip) that projects only the
+# fields the dashboard charts use, downsampled server-side into
+# DASHBOARD_BUCKET intervals. g_force and fall_detected keep the bucket peak
+# so impacts/falls aren't averaged away; emotion is a string, so last().
+# Aliases keep the original field names for the handlers below.
+DASHBOARD_QUERY = (
+    'SELECT mean(temperature) AS temperature, mean(humidity) AS humidity FROM environment '
+    'WHERE time > now() - 24h GROUP BY time({b}) fill(none); '
+    'SELECT max(g_force) AS g_force, mean(mic) AS mic FROM motion '
+    'WHERE time > now() - 24h GROUP BY time({b}) fill(none); '
+    'SELECT max(fall_detected) AS fall_detected, last(emotion) AS emotion FROM camera '
+    'WHERE time > now() - 24h GROUP BY time({b}) fill(none)'
+).format(b=config.DASHBOARD_BUCKET)
+
+
+# Dashboard results are reused for DASHBOARD_CACHE_TTL seconds so several
+# auto-refreshing tabs don't each re-scan 24h of data
+_dashboard_cache = {"ts": 0.0, "points": None}
+_dashboard_cache_lock = threading.Lock()
+
+
+def query_dashboard():
+    """Query the last 24 hours; returns (environment, motion, camera) point lists."""
+    # holding the lock while querying also collapses concurrent misses into one query
+    with _dashboard_cache_lock:
+        now = time.monotonic()
+        if _dashboard_cache["points"] is None or now - _dashboard_cache["ts"] >= config.DASHBOARD_CACHE_TTL:
+            results = influx_client.query(DASHBOARD_QUERY)
+            env_points, motion_points, camera_points = (list(r.get_points()) for r in results)
+            _dashboard_cache["points"] = (env_points, motion_points, camera_points)
+            _dashboard_cache["ts"] = now
+        return _dashboard_cache["points"]
+
+
 @app.route("/dashboard_data")
 def dashboard_data():
     # Query InfluxDB for last 24 hours
-    temp_result = influx_client.query('SELECT * FROM environment WHERE time > now() - 24h')
-    hum_result = influx_client.query('SELECT * FROM environment WHERE time > now() - 24h')
-    g_force_result = influx_client.query('SELECT * FROM motion WHERE time > now() - 24h')
-    fall_result = influx_client.query('SELECT * FROM camera WHERE time > now() - 24h')
-    emotion_result = influx_client.query('SELECT * FROM camera WHERE time > now() - 24h')
+    env_points, motion_points, camera_points = query_dashboard()
 
     # Process data for JSON
-    temp_data = []
-    hum_data = []
-    g_force_data = []
-    mic_data = []
-    fall_data = []
-    emotion_data = []
-
-    if temp_result:
-        for point in temp_result.get_points():
-            temp_data.append({"time": point['time'], "value": point.get('temperature', 0)})
-
-    if hum_result:
-        for point in hum_result.get_points():
-            hum_data.append({"time": point['time'], "value": point.get('humidity', 0)})
-
-    if g_force_result:
-        for point in g_force_result.get_points():
-            g_force_data.append({"time": point['time'], "value": point.get('g_force', 0)})
-            # motion measurement stores mic value as well
-            mic_data.append({"time": point['time'], "value": point.get('mic', 0)})
-
-    if fall_result:
-        for point in fall_result.get_points():
-            fall_data.append({"time": point['time'], "value": point.get('fall_detected', 0)})
-
-    # Map string emotions to numeric codes so frontend charting is consistent
-    emotion_map = {
-        'Neutral': 0,
-        'Happy': 1,
-        'Sad': 2,
-        'Surprised': 3,
-        'No Face': -1
-    }
-    if emotion_result:
-        for point in emotion_result.get_points():
-            raw = point.get('emotion', 'Unknown')
-            # Influx may return bytes/str; ensure str
-            try:
-                raw_str = str(raw)
-            except Exception:
-                raw_str = 'Unknown'
-            mapped = emotion_map.get(raw_str, -1)
-            emotion_data.append({"time": point['time'], "value": mapped})
-
-    return jsonify({
+    # every aggregate column is present in each row, but a bucket can still
+    # hold None for a field that had no samples in it
+    temp_data = [{"time": p['time'], "value": p['temperature']} for p in env_points]
+    hum_data = [{"time": p['time'], "value": p['humidity']} for p in env_points]
+    g_force_data = [{"time": p['time'], "value": p['g_force']} for p in motion_points]
+    # motion measurement stores mic value as well
+    mic_data = [{"time": p['time'], "value": p['mic']} for p in motion_points]
+    fall_data = [{"time": p['time'], "value": p['fall_detected']} for p in camera_points]
+
+    # Map string emotions to numeric codes so frontend charting is consistent.
+    # emotion is stored as a string field, so the raw value is the map key;
+    # missing/unknown labels map to -1
+    lookup = EMOTION_MAP.get
+    emotion_data = [{"time": p['time'], "value": lookup(p['emotion'], -1)} for p in camera_points]
+
+    # orjson serializes the (potentially large) point arrays in C
+    return Response(orjson.dumps({
         "temp_data": temp_data,
         "hum_data": hum_data,
         "g_force_data": g_force_data,
         "mic_data": mic_data,
         "fall_data": fall_data,
         "emotion_data": emotion_data
-    })
+    }), mimetype="application/json")
 
 @app.route("/dashboard")
 def dashboard():
     # Query InfluxDB for last 24 hours
-    temp_result = influx_client.query('SELECT * FROM environment WHERE time > now() - 24h')
-    hum_result = influx_client.query('SELECT * FROM environment WHERE time > now() - 24h')
-    g_force_result = influx_client.query('SELECT * FROM motion WHERE time > now() - 24h')
-    fall_result = influx_client.query('SELECT * FROM camera WHERE time > now() - 24h')
+    env_points, motion_points, camera_points = query_dashboard()
 
     # Process data for charts
-    temp_data = []
-    hum_data = []
-    g_force_data = []
-    fall_data = []
-
-    if temp_result:
-        for point in temp_result.get_points():
-            temp_data.append({"time": point['time'], "value": point['temperature']})
+    temp_data = [{"time": p['time'], "value": p['temperature']} for p in env_points]
+    hum_data = [{"time": p['time'], "value": p['humidity']} for p in env_points]
+    g_force_data = [{"time": p['time'], "value": p['g_force']} for p in motion_points]
+    fall_data = [{"time": p['time'], "value": p['fall_detected']} for p in camera_points]
 
-    if hum_result:
-        for point in hum_result.get_points():
-            hum_data.append({"time": point['time'], "value": point['humidity']})
+    return render_template("dashboard.html", temp_data=temp_data, hum_data=hum_data, g_force_data=g_force_data, fall_data=fall_data)
 
-    if g_force_result:
-        for point in g_force_result.get_points():
-            g_force_data.append({"time": point['time'], "value": point['g_force']})
 
-    if fall_result:
-        for point in fall_result.get_points():
-            fall_data.append({"time": point['time'], "value": point['fall_detected']})
+def start_services():
+    """Connect MQTT and start the background threads (once per process)."""
+    global mqtt
 
-    return render_template("dashboard.html", temp_data=temp_data, hum_data=hum_data, g_force_data=g_force_data, fall_data=fall_data)
+    # single stderr handler; a no-op if the host server already configured logging
+    logging.basicConfig(level=config.LOG_LEVEL, format="%(asctime)s %(levelname)s %(message)s")
 
+    influx_writer.start()
 
-if __name__ == '__main__':
     mqtt = MQTTHandler(config, on_message=on_mqtt_message)
     mqtt.connect_and_start()
 
@@ -532,9 +576,26 @@ if __name__ == '__main__':
     emotion_thread = threading.Thread(target=emotion_publish_loop, args=(mqtt,), daemon=True)
     emotion_thread.start()
 
-    # start Flask web server in main thread
+    # start the FaceMesh thread; it captures its own lores frames
+    face_thread = threading.Thread(target=face_loop, daemon=True)
+    face_thread.start()
+
+
+def stop_services():
+    """Stop recording, flush queued InfluxDB points and release the camera."""
+    log.info('Shutting down gateway')
+    picam2.stop_recording()
+    influx_writer.stop()
+    vision.close()
+
+
+if __name__ == '__main__':
+    start_services()
+
+    # start Flask app on a threaded WSGI server in main thread so the
+    # long-lived /video_feed streams don't block the API endpoints.
+    # waitress handles Ctrl+C itself and returns, so cleanup runs in finally
     try:
-        app.run(host="0.0.0.0", port=5000, debug=False)
-    except KeyboardInterrupt:
-        print('Shutting down gateway')
-        picam2.stop()
+        serve(app, host="0.0.0.0", port=5000, threads=config.WEB_THREADS)
+    finally:
+        stop_services()
@@ -0,0 +1,44 @@
+"""Single-slot "latest wins" buffer for handing frames between threads.
+
+The producer overwrites the slot on every `put()`, so a slow consumer simply
+skips stale frames instead of building up a backlog.
+"""
+import io
+import threading
+
+
+class FrameSlot:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._version = 0
+
+    def put(self, item):
+        with self._cond:
+            self._item = item
+            self._version += 1
+            self._cond.notify_all()
+
+    def get(self, last_version=0, timeout=None):
+        """Wait for an item newer than `last_version`.
+
+        Returns `(version, item)`; on timeout the version is unchanged.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != last_version, timeout)
+            return self._version, self._item
+
+
+class SlotWriter(io.BufferedIOBase):
+    """File-like adapter so an encoder output (e.g. picamera2 FileOutput)
+    writes each encoded frame into a FrameSlot."""
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        self.slot.put(buf)
+        return len(buf)
@@ -1,6 +1,7 @@
 """Hardware controller with safe fallbacks for non-Pi environments."""
 import time
 import random
+import threading
 
 try:
     from gpiozero import Buzzer, Servo, Button, RGBLED, LED
@@ -9,11 +10,11 @@ except Exception:
     HAVE_GPIOZERO = False
 
 try:
-    import adafruit_ads1x15.ads1115 as ADS
-    import busio
-    HAVE_ADC = True
+    # DMA-timed servo pulses through the pigpio daemon (pigpiod)
+    from gpiozero.pins.pigpio import PiGPIOFactory
+    HAVE_PIGPIO = True
 except Exception:
-    HAVE_ADC = False
+    HAVE_PIGPIO = False
 
 try:
     import adafruit_dht
@@ -41,10 +42,12 @@ class HardwareManager:
         self.rgb = None
         self.led = None
         self.smoke_sensor = None
+        # latest smoke level, kept current by edge callbacks (None = no sensor)
+        self._smoke_state = None
         if HAVE_GPIOZERO:
             try:
                 self.buzzer = Buzzer(self.cfg.PIN_BUZZER)
-                self.servo = Servo(self.cfg.PIN_SERVO)
+                self.servo = Servo(self.cfg.PIN_SERVO, pin_factory=self._servo_pin_factory())
                 # Initialize RGB LED if pins provided
                 try:
                     r = getattr(self.cfg, 'PIN_RGB_R', None)
@@ -62,6 +65,11 @@ class HardwareManager:
                 except Exception as e:
                     print(f"[HARDWARE] LED init failed: {e}")
                 self.smoke_sensor = Button(self.cfg.PIN_SMOKE, pull_up=True)
+                # gpiozero delivers pin edges from its own event thread, so
+                # read_env() just returns the cached level instead of polling
+                self.smoke_sensor.when_pressed = self._on_smoke_edge
+                self.smoke_sensor.when_released = self._on_smoke_edge
+                self._smoke_state = 1 if self.smoke_sensor.is_pressed else 0
                 self._gpio_ready = True
             except Exception as e:
                 print(f"[HARDWARE] GPIO init failed, falling back to mock mode: {e}")
@@ -71,27 +79,90 @@ class HardwareManager:
 
         # DHT device will be created lazily to avoid runtime errors on non-Pi
         self._dht = None
+        self._detach_timer = None
+        # xorshift32 state for mock readings (must be non-zero)
+        self._rng_state = random.getrandbits(32) | 1
+        self._dht_pin = self._resolve_dht_pin()
+        # A DHT read can block or fail for seconds, so it is sampled on a
+        # background thread and read_env() returns the last good reading
+        # until it is older than DHT_STALE_AFTER seconds
+        self._last_env = {'temp': None, 'hum': None, 'ts': None}
+        self._env_lock = threading.Lock()
+        if HAVE_DHT:
+            threading.Thread(target=self._dht_loop, daemon=True).start()
 
-        # No ADC needed for digital smoke
+    def _servo_pin_factory(self):
+        # pigpio generates servo pulses in hardware, so they don't jitter with
+        # CPU load; the default factory's software PWM is the fallback
+        if HAVE_PIGPIO:
+            try:
+                return PiGPIOFactory()
+            except Exception as e:
+                print(f"[HARDWARE] pigpiod not reachable, using software PWM for servo: {e}")
+        return None
+
+    def _resolve_dht_pin(self):
+        pin = getattr(self.cfg, 'PIN_DHT', None)
+        # map numeric BCM pin to board.D{n} if needed
+        if isinstance(pin, int) and HAVE_BOARD:
+            return getattr(board, f'D{pin}', None)
+        return pin
 
     def _init_dht(self):
         if HAVE_DHT and self._dht is None:
             try:
-                pin = getattr(self.cfg, 'PIN_DHT', None)
-                # map numeric BCM pin to board.D{n} if needed
-                if isinstance(pin, int) and HAVE_BOARD:
-                    board_attr = f'D{pin}'
-                    pin_obj = getattr(board, board_attr, None)
-                else:
-                    pin_obj = pin
-
-                # print(f"[DEBUG] Initializing DHT on pin {pin} (board.{board_attr})")
-                self._dht = adafruit_dht.DHT11(pin_obj)
+                self._dht = adafruit_dht.DHT11(self._dht_pin)
                 # print("[DEBUG] DHT initialized successfully")
             except Exception as e:
                 print(f"[DEBUG] DHT init failed: {e}")
                 self._dht = None
 
+    def _dht_loop(self):
+        # DHT11 needs >= 2 s between reads; failed reads keep the previous value
+        interval = getattr(self.cfg, 'DHT_SAMPLE_INTERVAL', 2.5)
+        while True:
+            self._init_dht()
+            if self._dht is not None:
+                try:
+                    # one sensor transaction; the property reads below are
+                    # served from the values it just decoded
+                    self._dht.measure()
+                    t = self._dht.temperature
+                    h = self._dht.humidity
+                    if t is not None and h is not None:
+                        with self._env_lock:
+                            self._last_env = {'temp': t, 'hum': h, 'ts': time.monotonic()}
+                except Exception as e:
+                    print(f"[DEBUG] DHT read failed: {e}")
+            time.sleep(interval)
+
+    def _fast_rand(self):
+        """Cheap xorshift32 PRNG for mock sensor values; returns 0-255."""
+        s = self._rng_state
+        s ^= (s << 13) & 0xffffffff
+        s ^= s >> 17
+        s ^= (s << 5) & 0xffffffff
+        self._rng_state = s
+        return s & 0xff
+
+    def _on_smoke_edge(self, device):
+        self._smoke_state = 1 if device.is_active else 0  # 1 if smoke detected
+
+    def _detach_servo_later(self, delay=1.0):
+        # give the servo time to reach its position, then stop driving it
+        # without blocking the caller; a newer move cancels a pending detach
+        if self._detach_timer is not None:
+            self._detach_timer.cancel()
+        self._detach_timer = threading.Timer(delay, self._safe_detach)
+        self._detach_timer.daemon = True
+        self._detach_timer.start()
+
+    def _safe_detach(self):
+        try:
+            self.servo.detach()
+        except Exception as e:
+            print(f"[HARDWARE] servo detach error: {e}")
+
     def trigger_emergency(self):
         """Activate buzzer and open the door (servo)."""
         print("[ACTUATOR] Emergency: buzzer ON, opening door (servo -> 90°)")
@@ -116,8 +187,7 @@ class HardwareManager:
                     except Exception:
                         pass
                 self.servo.max()
-                time.sleep(1)
-                self.servo.detach()
+                self._detach_servo_later()
             except Exception as e:
                 print(f"[HARDWARE] trigger_emergency GPIO error: {e}")
         else:
@@ -147,41 +217,26 @@ class HardwareManager:
                     except Exception:
                         pass
                 self.servo.min()
-                time.sleep(1)
-                self.servo.detach()
+                self._detach_servo_later()
             except Exception as e:
                 print(f"[HARDWARE] reset_emergency GPIO error: {e}")
 
     def read_env(self):
         """Read environment sensors: DHT and smoke via digital input. Returns a dict."""
-        # DHT
-        temp = None
-        hum = None
-        if HAVE_DHT:
-            self._init_dht()
-            if self._dht is not None:
-                for attempt in range(3):  # Retry up to 3 times
-                    try:
-                        temp = self._dht.temperature
-                        hum = self._dht.humidity
-                        # print(f"[DEBUG] DHT read: temp={temp}, hum={hum}")
-                        break  # Success, exit retry loop
-                    except Exception as e:
-                        print(f"[DEBUG] DHT read failed (attempt {attempt+1}): {e}")
-                        time.sleep(2)  # Wait before retry
-                else:
-                    print("[DEBUG] DHT read failed after 3 attempts")
-                    temp = None
-                    hum = None
-
-        # Smoke sensor: read from digital input if available, else mock
-        if self.smoke_sensor is not None:
-            try:
-                smoke_level = 1 if self.smoke_sensor.is_pressed else 0  # 1 if smoke detected
-            except Exception:
-                smoke_level = random.randint(0, 1)
-        else:
-            smoke_level = random.randint(0, 1)
+        # DHT: latest reading from the background sampler
+        with self._env_lock:
+            last = self._last_env
+        temp = last['temp']
+        hum = last['hum']
+        # a dead or unplugged sensor must read as "N/A", not as the old value
+        max_age = getattr(self.cfg, 'DHT_STALE_AFTER', 10.0)
+        if last['ts'] is None or time.monotonic() - last['ts'] > max_age:
+            temp = hum = None
+
+        # Smoke sensor: level cached from the digital input's edge events, else mock
+        smoke_level = self._smoke_state
+        if smoke_level is None:
+            smoke_level = self._fast_rand() >> 7
 
         return {"temp": (round(temp, 1) if temp is not None else "N/A"),
                 "humidity": (round(hum, 1) if hum is not None else "N/A"),
@@ -0,0 +1,159 @@
+"""Background batch writer for InfluxDB points.
+
+Producers format a point with `line_protocol()` and call
+`InfluxWriter.write(line)`, which only appends to an in-memory queue. A daemon
+thread drains the queue with line-protocol `write_points` calls of at most
+`INFLUX_BATCH_SIZE` points, every `INFLUX_FLUSH_INTERVAL` seconds or as soon as
+`INFLUX_FLUSH_POINTS` points are waiting, whichever comes first.
+"""
+import collections
+import logging
+import math
+import threading
+import time
+
+from influxdb.exceptions import InfluxDBClientError
+
+log = logging.getLogger("eldersafe")
+
+# multiplier from seconds / divisor from nanoseconds for each write precision
+_PRECISION_SCALE = {'s': 1, 'ms': 1e3, 'u': 1e6, 'n': 1e9}
+_PRECISION_NS_DIV = {'s': 10**9, 'ms': 10**6, 'u': 10**3, 'n': 1}
+
+
+def _escape_key(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ').replace('=', '\\=')
+
+
+def _format_field(value):
+    # Same typing as influxdb-python's JSON path so existing field types match
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(float(value))
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+
+def _writable(value):
+    # line protocol has no null, NaN or infinity
+    if value is None:
+        return False
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+
+def line_protocol(measurement, tags, fields, ts):
+    """Return one InfluxDB line-protocol string for the given point.
+
+    None and non-finite float fields are skipped; returns None if no field is
+    left, since a point without fields is invalid.
+    """
+    field_set = ",".join(f"{_escape_key(k)}={_format_field(v)}"
+                         for k, v in fields.items() if _writable(v))
+    if not field_set:
+        return None
+    key = str(measurement).replace(',', '\\,').replace(' ', '\\ ')
+    for k, v in sorted(tags.items()):
+        key += f",{_escape_key(k)}={_escape_key(v)}"
+    return f"{key} {field_set} {int(ts)}"
+
+
+class InfluxWriter:
+    def __init__(self, cfg, client):
+        self.cfg = cfg
+        self.client = client
+        self.batch_size = getattr(cfg, 'INFLUX_BATCH_SIZE', 1000)
+        self.flush_points = getattr(cfg, 'INFLUX_FLUSH_POINTS', 100)
+        self.flush_interval = getattr(cfg, 'INFLUX_FLUSH_INTERVAL', 1.0)
+        self.time_precision = getattr(cfg, 'INFLUX_TIME_PRECISION', 'ms')
+        self.max_backoff = getattr(cfg, 'INFLUX_RETRY_MAX_BACKOFF', 30.0)
+        self._ts_scale = _PRECISION_SCALE[self.time_precision]
+        self._ts_ns_div = _PRECISION_NS_DIV[self.time_precision]
+        # bounded so an unreachable InfluxDB can't grow memory without limit
+        self._queue = collections.deque(maxlen=getattr(cfg, 'INFLUX_QUEUE_MAX', 50000))
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flush thread and write whatever is still queued."""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+            self._thread = None
+        self.flush()
+
+    def timestamp(self, seconds=None):
+        """Convert a `time.time()` value (default: now) to the write precision."""
+        if seconds is None:
+            # integer clock, no float round-trip
+            return time.time_ns() // self._ts_ns_div
+        return int(seconds * self._ts_scale)
+
+    def write(self, line):
+        if line is None:
+            return  # line_protocol() had no writable fields
+        self._queue.append(line)
+        if len(self._queue) >= self.flush_points:
+            self._wake.set()
+
+    def flush(self):
+        """Write out the queue; returns False if a retryable error stopped it."""
+        while self._queue:
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            try:
+                self.client.write_points(batch, time_precision=self.time_precision,
+                                         batch_size=self.batch_size, protocol='line')
+            except InfluxDBClientError as e:
+                if e.code is not None and 400 <= e.code < 500:
+                    # rejected data (type conflict, bad line) fails the same
+                    # way on every retry, so it must not block later points
+                    log.error("[INFLUX] dropping %d points rejected by InfluxDB (%s): %s",
+                              len(batch), e.code, e)
+                    continue
+                self._requeue(batch, e)
+                return False
+            except Exception as e:
+                # InfluxDBServerError (5xx), connection errors, timeouts
+                self._requeue(batch, e)
+                return False
+        return True
+
+    def _requeue(self, batch, error):
+        log.warning("[INFLUX] batch write error (%d points), will retry: %s", len(batch), error)
+        # keep the points for the next flush; extendleft on a full deque would
+        # evict the newest points from the right, so when there is no room
+        # the oldest points of the batch are the ones dropped
+        room = self._queue.maxlen - len(self._queue)
+        if room < len(batch):
+            dropped = len(batch) - max(room, 0)
+            log.warning("[INFLUX] queue full, dropping %d oldest points", dropped)
+            batch = batch[dropped:]
+        self._queue.extendleft(reversed(batch))
+
+    def _flush_loop(self):
+        backoff = 0.0
+        while not self._stopped.is_set():
+            if backoff:
+                # InfluxDB is unreachable/failing: don't let write() wake-ups
+                # turn retries into a tight loop
+                self._stopped.wait(backoff)
+            else:
+                self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self.flush():
+                backoff = 0.0
+            else:
+                backoff = min(max(backoff * 2, self.flush_interval), self.max_backoff)
@@ -1,15 +1,38 @@
-"""Simple MQTT helper for publishing and subscribing."""
-import json
+"""Simple MQTT helper for publishing and subscribing.
+
+`publish()` never touches the socket: messages go on a queue drained by a
+dedicated publisher thread, so callers (including the MQTT receive callback)
+never wait on paho's client lock or payload serialization.
+"""
+import queue
+import threading
+import orjson
 import paho.mqtt.client as mqtt
 
 
+# Preformatted env telemetry payload; same keys/order as the read_env() dict
+_ENV_FMT = b'{"temp":%s,"humidity":%s,"smoke":%d,"timestamp":%.3f}'
+
+
+def _env_value(v):
+    # read_env() reports a failed DHT reading as the string "N/A"
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return b'%.1f' % v
+    return b'"N/A"'
+
+
 class MQTTHandler:
     def __init__(self, cfg, on_message=None):
         self.cfg = cfg
-        self.client = mqtt.Client()
+        # fixed client id + persistent session: the broker keeps our
+        # subscriptions across reconnects instead of starting from scratch
+        self.client = mqtt.Client(client_id=getattr(cfg, 'MQTT_CLIENT_ID', ''),
+                                  clean_session=not getattr(cfg, 'MQTT_CLIENT_ID', ''))
         if on_message:
             self.client.on_message = on_message
         self.client.on_connect = self._on_connect
+        self._outbox = queue.Queue(maxsize=getattr(cfg, 'MQTT_PUBLISH_QUEUE_MAX', 1000))
+        self._publisher = None
 
     def _on_connect(self, client, userdata, flags, rc):
         print(f"[MQTT] Connected with result code {rc}")
@@ -17,11 +40,31 @@ class MQTTHandler:
     def connect_and_start(self):
         self.client.connect(self.cfg.MQTT_BROKER, self.cfg.MQTT_PORT, 60)
         self.client.loop_start()
+        if self._publisher is None:
+            self._publisher = threading.Thread(target=self._publish_loop, daemon=True)
+            self._publisher.start()
 
     def publish(self, topic, payload, qos=0, retain=False):
-        if isinstance(payload, (dict, list)):
-            payload = json.dumps(payload)
-        self.client.publish(topic, payload, qos=qos, retain=retain)
+        """Queue a message; dicts/lists are JSON-encoded (orjson, bytes) on the publisher thread."""
+        try:
+            self._outbox.put_nowait((topic, payload, qos, retain))
+        except queue.Full:
+            print(f"[MQTT] Publish queue full, dropping message for {topic}")
+
+    def publish_env(self, temp, hum, smoke, ts):
+        """Queue one env telemetry message, formatted without a JSON encoder."""
+        self.publish(self.cfg.TOPIC_ENV,
+                     _ENV_FMT % (_env_value(temp), _env_value(hum), int(smoke), ts))
+
+    def _publish_loop(self):
+        while True:
+            topic, payload, qos, retain = self._outbox.get()
+            try:
+                if isinstance(payload, (dict, list)):
+                    payload = orjson.dumps(payload)
+                self.client.publish(topic, payload, qos=qos, retain=retain)
+            except Exception as e:
+                print(f"[MQTT] Publish error on {topic}: {e}")
 
     def subscribe(self, topic):
         self.client.subscribe(topic)
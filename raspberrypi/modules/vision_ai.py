@@ -1,54 +1,158 @@
 """Simple Vision system with graceful fallback when OpenCV isn't available.
 
 This module exposes `VisionSystem.analyze_scene()` which captures one frame
-and returns a dict: {"fall_detected": "0|1"}
+and returns a dict: {"fall_detected": 0|1, "confidence": float}
 In environments without camera/opencv, it returns mocked results.
 """
+import os
 import random
 
 try:
     import cv2
+    import numpy as np
     HAVE_CV = True
 except Exception:
     HAVE_CV = False
 
+# Face cascades in order of preference. The LBP cascade uses integer features
+# and runs ~2-3x faster than Haar; pip's opencv-python only bundles the Haar
+# files, so LBP is picked up from the system OpenCV data dirs when present.
+_LBP_FACE = 'lbpcascade_frontalface_improved.xml'
+_HAAR_FACE = 'haarcascade_frontalface_default.xml'
+
+
+def _face_cascade_paths():
+    # cv2.data only exists in the pip wheels; distro builds keep data under /usr/share
+    haar_dir = getattr(getattr(cv2, 'data', None), 'haarcascades', '/usr/share/opencv4/haarcascades/')
+    return [os.path.join(haar_dir, _LBP_FACE),
+            '/usr/share/opencv4/lbpcascades/' + _LBP_FACE,
+            '/usr/share/opencv/lbpcascades/' + _LBP_FACE,
+            os.path.join(haar_dir, _HAAR_FACE)]
+
+
+def _build_conf_lut():
+    """Confidence (in hundredths) indexed by [face_area_norm*100, ratio*100].
+
+    confidence = 0.6 * area + 0.4 * ratio_score, where ratio_score ramps from 0
+    at ratio 1.0 to 1 at ratio 1.5; capped at 0.99. Ratios above 1.5 clamp to
+    the last column.
+    """
+    area = np.arange(101, dtype=np.float64)[:, None] / 100.0
+    ratio = np.arange(151, dtype=np.float64)[None, :] / 100.0
+    ratio_score = np.clip((ratio - 1.0) / (1.5 - 1.0), 0.0, 1.0)
+    conf = np.minimum(0.99, 0.6 * area + 0.4 * ratio_score)
+    return np.rint(conf * 100).astype(np.uint8)
+
+
+def _load_face_cascade():
+    for path in _face_cascade_paths():
+        if os.path.exists(path):
+            cascade = cv2.CascadeClassifier(path)
+            if not cascade.empty():
+                print(f"[VISION] Face cascade: {os.path.basename(path)}")
+                return cascade
+    return None
+
 
 class VisionSystem:
-    def __init__(self, camera_index=0, picam2=None):
+    # Haar detection cost scales with W*H; frames are shrunk to this short edge
+    # first (a face big enough to matter for the heuristic survives easily)
+    DETECT_SHORT_EDGE = 240
+    # frames with less intensity variance than this skip face detection
+    MIN_FRAME_VARIANCE = 5.0
+
+    def __init__(self, camera_index=0, picam2=None, stream="main"):
         self.camera_index = camera_index
         self.picam2 = picam2  # Use Pi Camera if provided
+        self.stream = stream  # Picamera2 stream to capture from
+        self._cap = None  # USB capture, opened on first use and kept open
+        # frame/gray/downscaled buffers reused across calls (OpenCV reallocates
+        # them only if the input size changes)
+        self._frame = None
+        self._gray = None
+        self._small = None
         if HAVE_CV:
             # attempt to load cascade for face detection if possible
+            self._conf_lut = _build_conf_lut()
+            # Transparent API: with an OpenCL device, UMat inputs run the
+            # cascade there; otherwise detection stays on plain ndarrays
+            self._use_ocl = False
+            try:
+                if cv2.ocl.haveOpenCL():
+                    cv2.ocl.setUseOpenCL(True)
+                    self._use_ocl = cv2.ocl.useOpenCL()
+            except Exception:
+                self._use_ocl = False
             try:
-                self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+                self.face_cascade = _load_face_cascade()
             except Exception:
                 self.face_cascade = None
         else:
             print("[VISION] OpenCV not available; using mock vision outputs.")
 
+    def _open_usb(self):
+        cap = cv2.VideoCapture(self.camera_index, cv2.CAP_V4L2)
+        if not cap.isOpened():
+            cap.release()
+            return None
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 320)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 240)
+        # keep at most one queued frame so a grab() lands on a fresh one
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def _detect_faces(self, gray):
+        if self._use_ocl:
+            try:
+                return self.face_cascade.detectMultiScale(cv2.UMat(gray), 1.2, 6, minSize=(30, 30),
+                                                          flags=cv2.CASCADE_SCALE_IMAGE)
+            except Exception as e:
+                print(f"[VISION] OpenCL detection failed, using CPU: {e}")
+                self._use_ocl = False
+        return self.face_cascade.detectMultiScale(gray, 1.2, 6, minSize=(30, 30),
+                                                  flags=cv2.CASCADE_SCALE_IMAGE)
+
+    def close(self):
+        """Release the USB camera if one was opened."""
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
     def analyze_scene(self):
         """Capture an image and run quick heuristics for fall verification.
 
-        Returns a dict e.g. {"fall_detected":"1"}
+        Returns a dict e.g. {"fall_detected": 1, "confidence": 0.82}
         """
         if HAVE_CV:
             if self.picam2:
                 # Use Pi Camera
                 try:
-                    frame_raw = self.picam2.capture_array()
-                    if frame_raw.shape[2] == 4:
-                        frame = cv2.cvtColor(frame_raw, cv2.COLOR_BGRA2BGR)
+                    frame_raw = self.picam2.capture_array(self.stream)
+                    if frame_raw.ndim == 2:
+                        # YUV420: the top two thirds of the rows are the Y
+                        # (luma) plane, which is already a grayscale image
+                        gray = frame_raw[:frame_raw.shape[0] * 2 // 3]
                     else:
-                        frame = frame_raw.copy()
+                        # 3-channel RGB888/BGR888 stream
+                        gray = self._gray = cv2.cvtColor(frame_raw, cv2.COLOR_BGR2GRAY, dst=self._gray)
                 except Exception:
                     return None
             else:
-                # Fallback to USB camera
-                cam = cv2.VideoCapture(self.camera_index)
-                ret, frame = cam.read()
-                cam.release()
+                # Fallback to USB camera; reopening the V4L2 device per call
+                # costs far more than the detection itself
+                if self._cap is None:
+                    self._cap = self._open_usb()
+                    if self._cap is None:
+                        return None
+                # drop the buffered (stale) frame, then decode the fresh one
+                self._cap.grab()
+                ret, frame = self._cap.retrieve(self._frame)
                 if not ret or frame is None:
+                    # device may have gone away; reopen on the next call
+                    self.close()
                     return None
+                self._frame = frame
+                gray = self._gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
 
             # Improved heuristic: combine face bounding-box aspect ratio and face size
             # to produce a more stable confidence score in [0.0, 1.0]. If no face
@@ -58,16 +162,31 @@ class VisionSystem:
             fall_flag = False
             confidence = 0.0
 
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
             faces = []
             try:
                 if self.face_cascade is not None:
-                    faces = self.face_cascade.detectMultiScale(gray, 1.1, 4)
+                    scale = self.DETECT_SHORT_EDGE / min(gray.shape[0], gray.shape[1])
+                    if scale < 1.0:
+                        size = (round(gray.shape[1] * scale), round(gray.shape[0] * scale))
+                        small = self._small = cv2.resize(gray, size, dst=self._small,
+                                                         interpolation=cv2.INTER_AREA)
+                    else:
+                        small, scale = gray, 1.0
+                    # a flat (dark/covered/blank) frame can't contain a face
+                    _, std = cv2.meanStdDev(small)
+                    if std[0, 0] ** 2 >= self.MIN_FRAME_VARIANCE:
+                        # scaleFactor 1.2 roughly halves the pyramid levels of 1.1;
+                        # minNeighbors 6 compensates with stricter grouping
+                        faces = self._detect_faces(small)
+                    if len(faces) and scale != 1.0:
+                        # back to full-frame pixels so the area thresholds are unchanged
+                        faces = (faces / scale).astype(int)
             except Exception:
                 faces = []
 
-            frame_h, frame_w = frame.shape[0], frame.shape[1]
-            frame_area = max(1.0, float(frame_w * frame_h))
+            # integer pixel area; the face metrics below stay in integer
+            # hundredths, which is exactly what the confidence table indexes
+            frame_area = max(1, gray.shape[0] * gray.shape[1])
 
             if len(faces) == 0:
                 # No face found — this is a weaker but meaningful signal for lying
@@ -75,31 +194,28 @@ class VisionSystem:
                 confidence = 0.6
                 print(f"[VISION_DBG] faces=0 -> conf={confidence}")
             else:
-                (x, y, w, h) = faces[0]
-                ratio = (w / float(h)) if h != 0 else 0.0
-                face_area = float(w * h)
-                # face size relative to frame: normalized by an expected max face area
-                # (tunable; 0.12 corresponds to a fairly close face). Clamp to [0,1]
-                face_area_norm = min(1.0, max(0.0, face_area / (0.12 * frame_area)))
-
-                # ratio score: 0 when ratio<=1 (taller than wide), 1 when ratio>=1.5
-                ratio_score = 0.0
-                if ratio > 1.0:
-                    ratio_score = min(1.0, (ratio - 1.0) / (1.5 - 1.0))
+                x, y, w, h = (int(v) for v in faces[0])
+                # aspect ratio in hundredths (w/h * 100)
+                ri = (w * 100) // h if h else 0
+                # face size relative to frame, in hundredths of an expected max
+                # face area (tunable; 12% of the frame is a fairly close face),
+                # clamped to 100
+                ai = min(100, (w * h * 10000) // (12 * frame_area))
 
-                # combine signals (weights tuned empirically). Favor face size when ratio is weak.
-                confidence = 0.6 * face_area_norm + 0.4 * ratio_score
-                confidence = float(round(min(0.99, max(0.0, confidence)), 2))
+                # combine signals (weights tuned empirically, see _build_conf_lut):
+                # face size plus a ratio score that is 0 when ratio<=1 (taller
+                # than wide) and 1 when ratio>=1.5. Favor face size when ratio is weak.
+                confidence = self._conf_lut[ai, min(ri, 150)] / 100.0
 
-                # decide fall flag: require a reasonably strong ratio OR very large face area
-                if ratio_score >= 0.7 or face_area_norm >= 0.9:
-                    fall_flag = True
+                # decide fall flag: require a reasonably strong ratio (score >= 0.7,
+                # i.e. ratio >= 1.35) OR very large face area
+                fall_flag = ri >= 135 or ai >= 90
 
-                print(f"[VISION_DBG] faces={len(faces)} ratio={ratio:.2f} face_area_norm={face_area_norm:.3f} ratio_score={ratio_score:.3f} conf={confidence}")
+                print(f"[VISION_DBG] faces={len(faces)} ratio={ri / 100:.2f} face_area_norm={ai / 100:.2f} conf={confidence}")
 
-            return {"fall_detected": "1" if fall_flag else "0", "confidence": confidence}
+            return {"fall_detected": 1 if fall_flag else 0, "confidence": confidence}
 
         # Fallback mocked result (include a mock confidence)
-        mock_flag = random.choice(["0", "1"])
+        mock_flag = random.choice((0, 1))
         mock_conf = round(random.uniform(0.0, 1.0), 2)
         return {"fall_detected": mock_flag, "confidence": float(mock_conf)}
@@ -1,19 +1,56 @@
+import atexit
+import functools
+import os
+# Thread caps for a 4-core Pi running capture, inference, encode and the web
+# server side by side; tuned for this pipeline, not general defaults. The env
+# vars must be set before OpenCV/MediaPipe load their threading runtimes.
+os.environ.setdefault("OMP_NUM_THREADS", "2")
+os.environ.setdefault("MEDIAPIPE_DISABLE_GPU", "1")
 import cv2
-from flask import Flask, Response, render_template, jsonify
+from flask import Flask, Response, render_template
 import mediapipe as mp
 import numpy as np
 import time
+import math
+import operator
+from itertools import chain
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import paho.mqtt.client as mqtt
-import json
+import orjson
+from modules.frame_slot import FrameSlot
 
 # --- INITIALIZATION & GLOBAL STATE ---
 app = Flask(__name__)
 
+cv2.setNumThreads(2)
+
 # Camera setup (USB webcam)
-cap = cv2.VideoCapture(0)
-cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-time.sleep(0.5)  # Warm-up time
+def open_camera():
+    cam = cv2.VideoCapture(0, cv2.CAP_V4L2)
+    # MJPG before the size: compressed frames cross USB instead of raw YUYV, and
+    # many webcams only offer 640x480 at full frame rate in MJPG
+    cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    cam.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+    cam.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+    # keep at most one queued frame so reads don't lag behind the camera
+    cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    time.sleep(0.5)  # Warm-up time
+    return cam
+
+
+cap = open_camera()
+
+# MJPEG output: the overlay is drawn on the full 640x480 frame, the stream is
+# downscaled and encoded at a lower quality to cut imencode time and bytes sent
+STREAM_SIZE = (480, 360)
+JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), 70]
+# MediaPipe input size; landmarks are normalized, so boxes still map onto the
+# full-resolution display frame
+INFER_SIZE = (320, 240)
+# Run Pose on every POSE_EVERY-th frame and FaceMesh on every FACE_EVERY-th
+POSE_EVERY = 2
+FACE_EVERY = 5
 
 # MediaPipe setup
 mp_pose = mp.solutions.pose
@@ -21,14 +58,44 @@ mp_face_mesh = mp.solutions.face_mesh
 mp_drawing = mp.solutions.drawing_utils
 mp_drawing_styles = mp.solutions.drawing_styles
 
-# GLOBAL STATES
-fall_status = "Status: OK"
-global_temperature = "N/A"
-global_humidity = "N/A"
-global_smoke_status = "SMOKE_OK"
-global_critical_alert = "ALERT_OK"
-global_latest_g_force = 0.0
-global_expression = "Neutral"
+# MediaPipe graphs are built once at import and used only by infer_loop.
+# They are separate graphs, so infer_loop runs both on the same frame at once
+# (MediaPipe releases the GIL while a graph runs).
+pose = mp_pose.Pose(min_detection_confidence=0.5,
+                    min_tracking_confidence=0.5)
+face_mesh = mp_face_mesh.FaceMesh(max_num_faces=1,
+                                  refine_landmarks=False,  # classify_emotion only reads base-mesh points
+                                  min_detection_confidence=0.5,
+                                  min_tracking_confidence=0.5)
+mp_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mediapipe")
+atexit.register(pose.close)
+atexit.register(face_mesh.close)
+
+# GLOBAL STATE, keyed exactly as /env_status_api returns it. Writers publish
+# a new dict through update_state(); readers take `s = STATE` once and get a
+# consistent snapshot without locking (rebinding a module global is atomic).
+STATE = {
+    "temperature": "N/A",
+    "humidity": "N/A",
+    "fall_status": "Status: OK",
+    "smoke_status": "SMOKE_OK",
+    "critical_alert": "ALERT_OK",
+    "g_force_latest": 0.0,
+    "expression": "Neutral",
+}
+_state_lock = threading.Lock()
+# every real change to STATE is also published here for the /events stream
+state_updates = FrameSlot()
+
+
+def update_state(**changes):
+    global STATE
+    # the lock only serializes writers so concurrent updates aren't lost
+    with _state_lock:
+        if all(STATE.get(k) == v for k, v in changes.items()):
+            return  # nothing changed, nothing to push
+        STATE = {**STATE, **changes}
+        state_updates.put(STATE)
 
 # --- MQTT SETUP ---
 MQTT_BROKER = "localhost"
@@ -46,25 +113,26 @@ def on_connect(client, userdata, flags, rc):
     ])
 
 def on_message(client, userdata, msg):
-    global global_temperature, global_humidity, global_smoke_status
-    global global_critical_alert, global_latest_g_force, global_expression
-
     try:
-        data = json.loads(msg.payload.decode())
+        data = orjson.loads(msg.payload)
 
         if msg.topic == ENV_TOPIC:
-            global_temperature = str(data.get('temp', 'N/A'))
-            global_humidity = str(data.get('humidity', 'N/A'))
             smoke = data.get('smoke', 0)
-            global_smoke_status = "SMOKE_DETECTED" if smoke == 1 else "SMOKE_OK"
+            # numbers are kept as numbers (orjson emits them as-is); a
+            # failed DHT reading arrives as the string "N/A"
+            update_state(temperature=data.get('temp', 'N/A'),
+                         humidity=data.get('humidity', 'N/A'),
+                         smoke_status="SMOKE_DETECTED" if smoke == 1 else "SMOKE_OK")
 
         elif msg.topic == CAM_TOPIC:
-            fall = data.get('fall_detected', '0')
-            global_critical_alert = "FALL DETECTED" if fall == '1' else "ALERT_OK"
-            global_expression = data.get('emotions', 'Neutral')
+            # same normalization as the gateway (main.py) so both consumers
+            # of this topic read 1/true/"1" as a fall
+            fall = 1 if data.get('fall_detected') in (1, True, '1') else 0
+            update_state(critical_alert="FALL DETECTED" if fall == 1 else "ALERT_OK",
+                         expression=data.get('emotions', 'Neutral'))
 
         elif msg.topic == MOTION_TOPIC:
-            global_latest_g_force = data.get("g_force", 0.0)
+            update_state(g_force_latest=data.get("g_force", 0.0))
     except Exception as e:
         print("MQTT processing error:", e)
 
@@ -77,18 +145,17 @@ mqtt_client.loop_start()
 # --------------------------------------------------
 # FACIAL EXPRESSION DETECTION
 # --------------------------------------------------
-def euclidean(p1, p2):
-    return np.linalg.norm(np.array([p1.x, p1.y]) - np.array([p2.x, p2.y]))
+# Eye corners (33, 263), mouth corners (61, 291), inner lips (13, 14);
+# fetched from the landmark list in a single C-level call per frame
+_emotion_landmarks = operator.itemgetter(33, 263, 61, 291, 13, 14)
 
 def classify_emotion(lm):
-    LEC, REC = 33, 263
-    ML, MR = 61, 291
-    LU, LD = 13, 14
-    io = euclidean(lm[LEC], lm[REC])
+    lec, rec, ml, mr, lu, ld = _emotion_landmarks(lm)
+    io = math.hypot(lec.x - rec.x, lec.y - rec.y)
     if io < 1e-6: return "Neutral"
 
-    mw = euclidean(lm[ML], lm[MR]) / io
-    mo = euclidean(lm[LU], lm[LD]) / io
+    mw = math.hypot(ml.x - mr.x, ml.y - mr.y) / io
+    mo = math.hypot(lu.x - ld.x, lu.y - ld.y) / io
 
     if mo > 0.08: return "Surprised"
     if mw > 0.48: return "Happy"
@@ -102,6 +169,8 @@ def fall_classifier(r, w, h):
     if not r.pose_landmarks:
         return "Status: NO POSE"
 
+    if h <= 0:
+        return "Status: OK"  # degenerate box (all landmarks on one row)
     ar = w / h
     if ar > 1.3:
         return "!!! FALL DETECTED !!!"
@@ -109,62 +178,169 @@ def fall_classifier(r, w, h):
     return "Status: OK"
 
 # --------------------------------------------------
-# MAIN VIDEO STREAM LOOP
+# OVERLAY TEXT
 # --------------------------------------------------
-def generate_frames():
-    global fall_status, global_expression
+# The labels take only a handful of distinct values, so each is rasterized
+# once by cv2.putText and later frames just copy the cached pixels in.
+@functools.lru_cache(maxsize=32)
+def _text_patch(text, color, scale, thickness):
+    (tw, th), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    pad = thickness
+    patch = np.zeros((th + baseline + 2 * pad, tw + 2 * pad, 3), np.uint8)
+    # LINE_8 (putText's default) draws without anti-aliasing, so the set
+    # pixels form an exact mask
+    cv2.putText(patch, text, (pad, th + pad), cv2.FONT_HERSHEY_SIMPLEX, scale, color, thickness)
+    mask = patch.any(axis=2)[..., None]
+    # offsets from the putText origin (bottom-left of the text) to the patch corner
+    return patch, mask, -pad, -(th + pad)
 
-    with mp_pose.Pose(min_detection_confidence=0.5,
-                      min_tracking_confidence=0.5) as pose, \
-         mp_face_mesh.FaceMesh(max_num_faces=1,
-                               refine_landmarks=True,
-                               min_detection_confidence=0.5,
-                               min_tracking_confidence=0.5) as face:
 
-        while True:
+def draw_text(frame, text, org, color, scale, thickness):
+    """Same output as cv2.putText(FONT_HERSHEY_SIMPLEX), from a cached patch."""
+    patch, mask, dx, dy = _text_patch(text, color, scale, thickness)
+    x0, y0 = org[0] + dx, org[1] + dy
+    ph, pw = patch.shape[:2]
+    fh, fw = frame.shape[:2]
+    # clip to the frame (the pose label can sit partly above the top edge)
+    cx0, cy0 = max(x0, 0), max(y0, 0)
+    cx1, cy1 = min(x0 + pw, fw), min(y0 + ph, fh)
+    if cx0 >= cx1 or cy0 >= cy1:
+        return
+    src = (slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0))
+    np.copyto(frame[cy0:cy1, cx0:cx1], patch[src], where=mask[src])
+
+# --------------------------------------------------
+# MAIN VIDEO STREAM PIPELINE
+# --------------------------------------------------
+# capture_loop -> raw_frames -> infer_loop -> annotated_frames -> encode_loop
+# -> jpeg_frames -> generate_frames (one per client). Each stage runs on its
+# own thread, so the frame rate is set by the slowest stage instead of the sum
+# of all of them; every hand-off is a latest-wins slot, so a slow stage skips
+# stale frames rather than queueing them.
+raw_frames = FrameSlot()
+annotated_frames = FrameSlot()
+jpeg_frames = FrameSlot()
+
+
+def capture_loop():
+    global cap
+    while True:
+        try:
+            # a fresh buffer per frame: the previous one may still be in use
+            # by the inference stage
             ret, frame = cap.read()
             if not ret:
+                # webcam missing or unplugged: back off and reopen it
+                # instead of spinning on read()
+                print("[STREAM] camera read failed, reopening")
+                cap.release()
+                time.sleep(1.0)
+                cap = open_camera()
                 continue
+            # mirror in place (cv2.flip swaps pixel pairs, so src == dst is safe)
+            cv2.flip(frame, 1, dst=frame)
+            # shrink first so the color conversion also runs on 1/4 of the pixels
+            small = cv2.resize(frame, INFER_SIZE, interpolation=cv2.INTER_AREA)
+            rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+            # lets MediaPipe wrap the buffer without copying it
+            rgb.flags.writeable = False
+            raw_frames.put((frame, rgb))
+        except Exception as e:
+            print(f"[STREAM] capture error: {e}")
+            time.sleep(0.5)
+
 
-            frame = cv2.flip(frame, 1)
+def infer_loop():
+    version = 0
+    n = 0
+    pose_result = face_result = None
+    while True:
+        try:
+            version, (frame, rgb) = raw_frames.get(version)
             h, w, _ = frame.shape
-            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+            # Falls and expressions change over seconds, so each model runs on
+            # its own cadence and the previous result is reused in between; the
+            # offsets keep the two from landing on the same frame most of the time
+            run_pose = pose_result is None or n % POSE_EVERY == 0
+            run_face = face_result is None or n % FACE_EVERY == 1
+            n += 1
+
+            # only this thread submits to the MediaPipe graphs; rgb is not
+            # written to again, so both can read it concurrently
+            pose_future = mp_pool.submit(pose.process, rgb) if run_pose else None
+            face_future = mp_pool.submit(face_mesh.process, rgb) if run_face else None
+            if pose_future is not None:
+                pose_result = pose_future.result()
+            if face_future is not None:
+                face_result = face_future.result()
 
             # Pose
-            pose_result = pose.process(rgb)
+            status = STATE["fall_status"]
             if pose_result.pose_landmarks:
-                xs = [lm.x * w for lm in pose_result.pose_landmarks.landmark]
-                ys = [lm.y * h for lm in pose_result.pose_landmarks.landmark]
-                x1, y1 = int(min(xs)), int(min(ys))
-                x2, y2 = int(max(xs)), int(max(ys))
-                fall_status = fall_classifier(pose_result, x2-x1, y2-y1)
-                color = (0,255,0) if "OK" in fall_status else (0,0,255)
+                landmarks = pose_result.pose_landmarks.landmark
+                # one pass over the landmarks into an (N, 2) array, then
+                # vectorized min/max for the bounding box
+                pts = np.fromiter(chain.from_iterable((lm.x, lm.y) for lm in landmarks),
+                                  dtype=np.float32, count=2 * len(landmarks)).reshape(-1, 2)
+                size = np.array((w, h), dtype=np.float32)
+                x1, y1 = (pts.min(axis=0) * size).astype(int).tolist()
+                x2, y2 = (pts.max(axis=0) * size).astype(int).tolist()
+                status = fall_classifier(pose_result, x2-x1, y2-y1)
+                color = (0,255,0) if "OK" in status else (0,0,255)
                 cv2.rectangle(frame,(x1,y1),(x2,y2),color,3)
-                cv2.putText(frame, fall_status,(x1,y1-10),
-                            cv2.FONT_HERSHEY_SIMPLEX,0.7,color,2)
+                draw_text(frame, status, (x1, y1-10), color, 0.7, 2)
 
             # FaceMesh → Expression
-            face_result = face.process(rgb)
             expression = "No Face"
             if face_result.multi_face_landmarks:
                 lm = face_result.multi_face_landmarks[0].landmark
                 expression = classify_emotion(lm)
-            global_expression = expression
-            cv2.putText(frame,f"Expr: {expression}",(10,30),
-                        cv2.FONT_HERSHEY_SIMPLEX,1,(255,255,0),2)
+            update_state(fall_status=status, expression=expression)
+            draw_text(frame, f"Expr: {expression}", (10, 30), (255,255,0), 1, 2)
+
+            annotated_frames.put(frame)
+        except Exception as e:
+            print(f"[STREAM] inference error: {e}")
+
+
+def encode_loop():
+    version = 0
+    small = None  # owned by this thread, reused every frame
+    while True:
+        try:
+            version, frame = annotated_frames.get(version)
+            small = cv2.resize(frame, STREAM_SIZE, dst=small, interpolation=cv2.INTER_AREA)
+            ret, buf = cv2.imencode(".jpg", small, JPEG_PARAMS)
+            if ret:
+                jpeg_frames.put(buf.tobytes())
+        except Exception as e:
+            print(f"[STREAM] encode error: {e}")
 
-            ret, buf = cv2.imencode(".jpg", frame)
-            if not ret: continue
-            yield(b"--frame\r\nContent-Type:image/jpeg\r\n\r\n"+buf.tobytes()+b"\r\n")
+
+def generate_frames():
+    version = 0
+    while True:
+        new_version, jpeg = jpeg_frames.get(version, timeout=1.0)
+        if new_version == version:
+            continue  # timed out: nothing new, don't resend the old frame
+        version = new_version
+        yield(b"--frame\r\nContent-Type:image/jpeg\r\n\r\n"+jpeg+b"\r\n")
+
+
+def start_pipeline():
+    for target in (capture_loop, infer_loop, encode_loop):
+        threading.Thread(target=target, daemon=True).start()
 
 # --------------------------------------------------
 # FLASK ROUTES
 # --------------------------------------------------
 @app.route("/")
 def index():
+    s = STATE
     return render_template("index.html",
-                           temp=global_temperature,
-                           hum=global_humidity)
+                           temp=s["temperature"],
+                           hum=s["humidity"])
 
 @app.route("/video_feed")
 def video_feed():
@@ -173,24 +349,35 @@ def video_feed():
 
 @app.route("/env_status_api")
 def env_status_api():
-    global global_temperature, global_humidity, fall_status
-    global global_smoke_status, global_critical_alert
-    global global_latest_g_force, global_expression
-
-    return jsonify({
-        "temperature": global_temperature,
-        "humidity": global_humidity,
-        "fall_status": fall_status,
-        "smoke_status": global_smoke_status,
-        "critical_alert": global_critical_alert,
-        "g_force_latest": global_latest_g_force,
-        "expression": global_expression
-    })
+    # STATE already has the response's keys; orjson serializes the snapshot
+    # directly, no per-poll dict build
+    return Response(orjson.dumps(STATE), mimetype="application/json")
+
+def event_stream():
+    # the current state first, then one event per change
+    version, s = state_updates.get(-1)  # -1 never matches: returns at once
+    if s is None:
+        s = STATE  # nothing has changed since startup
+    while True:
+        yield b"data: " + orjson.dumps(s) + b"\n\n"
+        while True:
+            new_version, s = state_updates.get(version, timeout=15)
+            if new_version != version:
+                version = new_version
+                break
+            # comment line keeps proxies from closing an idle stream
+            yield b": keepalive\n\n"
+
+@app.route("/events")
+def events():
+    return Response(event_stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
 
 # --------------------------------------------------
 if __name__ == "__main__":
+    start_pipeline()
     try:
-        app.run(host="0.0.0.0", port=5000)
+        app.run(host="0.0.0.0", port=5000, threaded=True)
     finally:
         mqtt_client.loop_stop()
         cap.release()
\ No newline at end of file